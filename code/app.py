@@ -4,19 +4,33 @@ To run this in production mode and development mode:
 
 $ streamlit run app.py logging
 $ streamlit run app.py demo debug logging
+$ streamlit run app.py debug profiling
 
 Do not use linux command line options like --demo because then linux and
 streamlit think those arguments are streamlit arguments.
 
+In demo mode annotations are written to config.DEMO_ANNOTATIONS instead of to
+the real annotations file.
+
+With the 'profiling' argument the hot paths are timed and the timings are
+available in the Metrics pane and in config.METRICS_FILE.
+
+With the 'lazy' argument annotation files and sources are only read when they
+are needed, progress for unread files comes from config.SUMMARY_FILE. Opening
+the Progress pane for the first time does read all annotation files.
+
 """
 
 import sys
+import time
 import streamlit as st
 
 import config
 import utils
 import model
 
+rerun_start = time.perf_counter()
+
 st.set_page_config(layout="wide")
 
 utils.Messages.log(('-' * 80))
@@ -25,9 +39,13 @@ utils.Messages.log(('-' * 80))
 config.update(sys.argv[1:])
 
 # Load the underlying data from the model and get the next entity
-corpus = model.Corpus(config.ENTITIES, config.SOURCES)
-link_annotations = model.LinkAnnotations(corpus, config.ANNOTATIONS)
-entity = corpus.next()
+with utils.Metrics.timer('load corpus'):
+    corpus = model.Corpus(config.ENTITIES, config.SOURCES)
+with utils.Metrics.timer('load annotations'):
+    link_annotations = model.LinkAnnotations(corpus, config.ANNOTATIONS)
+with utils.Metrics.timer('next'):
+    entity = corpus.next()
+utils.Metrics.count('reruns')
 
 utils.Messages.log(utils.feature_as_string('current entity', entity))
 utils.Messages.log(utils.feature_as_string('session_state', st.session_state))
@@ -81,10 +99,13 @@ def validate_and_add(focus_entity: model.Entity, link: str, comment: str, post=N
     utils.Messages.log(utils.feature_as_string('link', link))
     utils.Messages.log(utils.feature_as_string('session_state', st.session_state))
     utils.Messages.log('Trying [%s] -> [%s] (%s)' % (focus_entity.text(), link, comment))
-    if utils.validate_link(link):
+    with utils.Metrics.timer('validate link'):
+        is_valid = utils.validate_link(link)
+    if is_valid:
         focus_entity.link = link
         focus_entity.comment = comment
-        link_annotations.add_link(focus_entity, link, comment)
+        with utils.Metrics.timer('write annotation'):
+            link_annotations.add_link(focus_entity, link, comment)
         utils.Messages.info("Linked **%s** to %s (%s)"
                             % (focus_entity.text(), link, comment))
         utils.Messages.log_info("Linked [%s] to [%s] (%s)"
@@ -106,25 +127,39 @@ st.sidebar.button('Backup', on_click=backup)
 # Add the sidebar radio button group with choices
 choices = ['Annotations', 'Progress', 'Messages', 'Help']
 choices.extend(['State'] if config.DEBUG else [])
+choices.extend(['Metrics'] if config.PROFILING else [])
 choice = st.sidebar.radio(
     "Choose", choices, label_visibility='hidden')
 
 # Add overall progress status to the sidebar
-total_types, percentage_done, _ = corpus.status()
+with utils.Metrics.timer('status'):
+    total_types, percentage_done, _ = corpus.status()
 st.sidebar.write('Done %d%% of %d types' % (percentage_done, total_types))
 
 # The main area of the window with the entity and its context
 st.info("**[%s]** (%s)\n" % (entity.text(), entity.entity_class()))
-utils.html(st, entity.contexts_as_html(corpus, limit=10))
+with utils.Metrics.timer('render contexts'):
+    utils.html(st, entity.contexts_as_html(corpus, limit=10))
 
 # See if the tool suggests a link given past annotations, if so add it to the
 # main area accompanied by a button to accept the suggestion
-suggested_link = corpus.suggest_link(entity.text())
+with utils.Metrics.timer('suggest link'):
+    suggested_link = corpus.suggest_link(entity.text())
+utils.Metrics.count('suggestion hits' if suggested_link is not None else 'suggestion misses')
 utils.Messages.log(utils.feature_as_string('suggested link', suggested_link))
 st.write('')
 if suggested_link is not None:
     st.write('Suggested link: %s' % suggested_link)
     st.button('Accept Suggested Link', on_click=add_link, args=(suggested_link,))
+else:
+    # No link for this exact string, so look for links of similar strings
+    with utils.Metrics.timer('suggest candidates'):
+        candidates = corpus.suggest_candidates(entity)
+    for n, (candidate_link, score, candidate_text) in enumerate(candidates):
+        st.write('Possible link: %s (from "%s", score %.2f)'
+                 % (candidate_link, candidate_text, score))
+        st.button('Accept Possible Link', key='candidate%d' % n,
+                  on_click=add_link, args=(candidate_link,))
 
 # Input field where the user can add a link and comment
 st.text_input('Enter link and an optional comment', key='entity_type', on_change=add_link)
@@ -138,8 +173,14 @@ with st.container():
     elif choice == 'Annotations':
         utils.show_annotations(st, link_annotations, fix_link)
     elif choice == 'Progress':
-        utils.show_progress(st, corpus)
+        with utils.Metrics.timer('progress pane'):
+            utils.show_progress(st, corpus, link_annotations)
     elif choice == 'Help':
         utils.show_help(st)
     elif choice == 'State':
         utils.show_state(st, sys.modules[__name__])
+    elif choice == 'Metrics':
+        utils.show_metrics(st)
+
+utils.Metrics.record('rerun', time.perf_counter() - rerun_start)
+utils.Metrics.dump()
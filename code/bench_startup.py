@@ -0,0 +1,111 @@
+"""Benchmark for startup time
+
+Measures the time from starting a new Python process to having the first
+entity rendered, that is, the entity with its contexts as HTML and a link
+suggestion. Every run is a fresh process so imports are never cached. The
+child process does what app.py does before the page shows, except for the
+Streamlit rendering itself. Use --streamlit to include the Streamlit import.
+
+$ python bench_startup.py
+$ python bench_startup.py --runs 10 --lazy --streamlit
+$ python bench_startup.py --sources ../data/sources --entities ../data/annotations
+
+Without --sources and --entities a synthetic corpus is used. With --record
+the results are appended as a JSON line to a file, together with a label like
+a release number, so startup times can be tracked across releases.
+
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+import loadtest
+
+
+CHILD = """
+import sys, time, json
+t0 = float(sys.argv[1])
+phases = {}
+def phase(name):
+    global t0
+    t1 = time.time()
+    phases[name] = t1 - t0
+    t0 = t1
+if 'streamlit' in sys.argv:
+    import streamlit
+    phase('import streamlit')
+import config, utils, model
+phase('import modules')
+config.update(sys.argv[5:])
+config.ANNOTATIONS = sys.argv[4]
+config.SUMMARY_FILE = sys.argv[4] + '.summary'
+corpus = model.Corpus(sys.argv[3], sys.argv[2])
+phase('load corpus')
+link_annotations = model.LinkAnnotations(corpus, config.ANNOTATIONS)
+phase('load annotations')
+entity = corpus.next()
+corpus.status()
+html = entity.contexts_as_html(corpus, limit=10)
+if corpus.suggest_link(entity.text()) is None:
+    corpus.suggest_candidates(entity)
+phase('first entity')
+print(json.dumps(phases))
+"""
+
+
+def run_once(sources, entities, annotations, arguments):
+    t0 = time.time()
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD, str(t0), sources, entities, annotations] + arguments,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True).stdout
+    total = time.time() - t0
+    phases = json.loads(output.strip().split('\n')[-1])
+    phases['total'] = total
+    return phases
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--sources')
+    parser.add_argument('--entities')
+    parser.add_argument('--files', type=int, default=100, help='files in the synthetic corpus')
+    parser.add_argument('--lazy', action='store_true')
+    parser.add_argument('--streamlit', action='store_true', help='include importing streamlit')
+    parser.add_argument('--record', help='file to append the results to')
+    parser.add_argument('--label', default='', help='label for the recorded results')
+    args = parser.parse_args()
+    arguments = (['lazy'] if args.lazy else []) + (['streamlit'] if args.streamlit else [])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if args.sources and args.entities:
+            sources, entities = args.sources, args.entities
+        else:
+            sources, entities = loadtest.make_corpus(tmpdir, files=args.files)
+        annotations = os.path.join(tmpdir, 'annotations.tab')
+        results = [run_once(sources, entities, annotations, arguments)
+                   for _ in range(args.runs)]
+    print('runs=%d lazy=%s streamlit=%s\n' % (args.runs, args.lazy, args.streamlit))
+    print('%-18s %9s %9s %9s' % ('phase', 'median', 'min', 'max'))
+    summary = {}
+    for phase in results[0]:
+        times = [result[phase] * 1000 for result in results]
+        summary[phase] = round(statistics.median(times), 1)
+        print('%-18s %9.1f %9.1f %9.1f'
+              % (phase, statistics.median(times), min(times), max(times)))
+    print('\ntimes in milliseconds, later runs benefit from the file system cache')
+    if args.record:
+        with open(args.record, 'a') as fh:
+            fh.write(json.dumps({'label': args.label, 'timestamp': time.time(),
+                                 'lazy': args.lazy, 'streamlit': args.streamlit,
+                                 'median_ms': summary}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
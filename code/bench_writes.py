@@ -0,0 +1,97 @@
+"""Benchmark for writing annotations
+
+Measures append latency and annotations per second for sustained input from a
+number of concurrent writers. It compares the old way of writing (open the
+file in append mode for each annotation, no fsync), an fsync for each line,
+and the group-committing AnnotationLog.
+
+$ python bench_writes.py
+$ python bench_writes.py --writers 8 --annotations 500 --delay 0.002
+
+Files are written to a temporary directory which is removed afterwards.
+
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import threading
+
+import config
+import storage
+import utils
+
+
+LINE = '%d\t2022-11-01 12:00:00\tcpb-aacip-507-0000000001-transcript.ann\tJim Lehrer\tPerson\t12\thttps://en.wikipedia.org/wiki/Jim_Lehrer\tbenchmark'
+
+
+def append_naive(file_name):
+    def append(line):
+        with open(file_name, 'a') as fh:
+            fh.write(line + '\n')
+    return append
+
+
+def append_fsync(file_name):
+    lock = threading.Lock()
+    def append(line):
+        with lock:
+            with open(file_name, 'a') as fh:
+                fh.write(line + '\n')
+                fh.flush()
+                os.fsync(fh.fileno())
+    return append
+
+
+def append_group(file_name, delay):
+    log = storage.AnnotationLog(file_name, commit_delay=delay)
+    def append(line):
+        # the log puts in its own identifier
+        log.append(line.split('\t', 1)[1])
+    return append
+
+
+def run(name, append, writers, annotations):
+    def writer(offset):
+        for n in range(annotations):
+            t0 = time.perf_counter()
+            append(LINE % (offset + n))
+            utils.Metrics.record(name, time.perf_counter() - t0)
+    threads = [threading.Thread(target=writer, args=(i * annotations,))
+               for i in range(writers)]
+    t0 = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return writers * annotations / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--annotations', type=int, default=250)
+    parser.add_argument('--delay', type=float, default=0.0)
+    args = parser.parse_args()
+    config.PROFILING = True
+    throughput = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        modes = [('append', append_naive(os.path.join(tmpdir, 'naive.tab'))),
+                 ('append+fsync', append_fsync(os.path.join(tmpdir, 'fsync.tab'))),
+                 ('group commit', append_group(os.path.join(tmpdir, 'group.tab'), args.delay))]
+        for name, append in modes:
+            throughput[name] = run(name, append, args.writers, args.annotations)
+        log = storage.AnnotationLog(os.path.join(tmpdir, 'group.tab'))
+        assert len(log.read()) == args.writers * args.annotations
+    print('writers=%d annotations=%d delay=%s\n'
+          % (args.writers, args.annotations, args.delay))
+    print('%-14s %10s %8s %8s %8s %8s' % ('mode', 'annos/sec', 'mean', 'p50', 'p99', 'max'))
+    for name, _count, mean, p50, _p90, p99, maximum in utils.Metrics.timer_summary():
+        print('%-14s %10d %8.3f %8.3f %8.3f %8.3f'
+              % (name, throughput[name], mean, p50, p99, maximum))
+    print('\nlatencies in milliseconds')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""Fuzzy link candidates
+
+Approximate matching of entity strings against strings that were linked
+before, so that "Lehrer", "Jim Lehrer" and "JIM LEHRER" can help each other.
+Strings are represented by their character trigrams and their words, and the
+similarity of two strings is the cosine of their feature sets. The overlap
+counts for all indexed strings are computed in one go with numpy from an
+inverted index of features.
+
+"""
+
+import re
+import threading
+import collections
+
+import numpy as np
+
+
+def normalize(text: str) -> str:
+    """Lowercase the text and replace any run of non-word characters with a
+    single space."""
+    return ' '.join(re.split(r'\W+', text.lower())).strip()
+
+
+def features(normalized_text: str) -> set:
+    """Return the character trigrams of the padded text as well as all words,
+    words are marked so they never clash with trigrams."""
+    padded = ' %s ' % normalized_text
+    grams = {padded[i:i + 3] for i in range(len(padded) - 2)}
+    words = {'w:%s' % word for word in normalized_text.split()}
+    return grams | words
+
+
+class CandidateIndex(object):
+
+    """An index over linked entity strings.
+
+    strings: list     -  normalized entity strings, the position is the string id
+    classes: list     -  entity class for each string id
+    links: list       -  Counter of links for each string id
+    sizes: list       -  number of features for each string id
+    string_ids: dict  -  { (normalized string, entity class) => string id }
+    postings: dict    -  { feature => list of string ids }
+
+    The numpy versions of the postings, sizes and classes are created on demand
+    and dropped when the index changes. An index is shared by all sessions in
+    a process, so changes and queries are done under a lock.
+
+    """
+
+    def __init__(self):
+        self.strings = []
+        self.classes = []
+        self.links = []
+        self.sizes = []
+        self.string_ids = {}
+        self.postings = {}
+        self._arrays = {}
+        self._sizes = None
+        self._classes = None
+        self._class_codes = {}
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return '<CandidateIndex strings=%d features=%d>' % (len(self), len(self.postings))
+
+    def __len__(self):
+        return len(self.strings)
+
+    def add(self, text: str, entity_class: str, link: str):
+        """Add a linked entity string to the index. Empty links are ignored
+        since they do not help anyone."""
+        if not link:
+            return
+        normalized = normalize(text)
+        if not normalized:
+            return
+        with self._lock:
+            self._add(normalized, entity_class, link)
+
+    def remove(self, text: str, entity_class: str, link: str):
+        """Remove one occurrence of a link for an entity string, this is used
+        when a link is replaced. The string itself stays in the index, strings
+        without links are never returned as candidates."""
+        with self._lock:
+            string_id = self.string_ids.get((normalize(text), entity_class))
+            if string_id is not None and self.links[string_id][link] > 0:
+                self.links[string_id][link] -= 1
+                if not self.links[string_id][link]:
+                    del self.links[string_id][link]
+
+    def _add(self, normalized: str, entity_class: str, link: str):
+        key = (normalized, entity_class)
+        string_id = self.string_ids.get(key)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.string_ids[key] = string_id
+            self.strings.append(normalized)
+            self.classes.append(self._class_codes.setdefault(entity_class, len(self._class_codes)))
+            self.links.append(collections.Counter())
+            string_features = features(normalized)
+            self.sizes.append(len(string_features))
+            for feature in string_features:
+                self.postings.setdefault(feature, []).append(string_id)
+                self._arrays.pop(feature, None)
+            self._sizes = None
+            self._classes = None
+        self.links[string_id][link] += 1
+
+    def candidates(self, text: str, entity_class: str = None,
+                   limit: int = 3, threshold: float = 0.5) -> list:
+        """Return up to limit (link, score, matched string) triples for strings
+        similar to text, best first. If an entity class is given only strings
+        of that class are considered."""
+        with self._lock:
+            return self._candidates(text, entity_class, limit, threshold)
+
+    def _candidates(self, text, entity_class, limit, threshold):
+        normalized = normalize(text)
+        query_features = features(normalized)
+        arrays = [self._posting_array(f) for f in query_features if f in self.postings]
+        if not arrays:
+            return []
+        if entity_class is not None and entity_class not in self._class_codes:
+            return []
+        overlap = np.bincount(np.concatenate(arrays), minlength=len(self.strings))
+        scores = overlap / np.sqrt(len(query_features) * self._size_array())
+        if entity_class is not None:
+            scores[self._class_array() != self._class_codes[entity_class]] = 0
+        hits = np.flatnonzero(scores >= threshold)
+        hits = hits[np.argsort(-scores[hits], kind='stable')]
+        result = []
+        seen = set()
+        for string_id in hits:
+            if not self.links[string_id]:
+                continue
+            link = self.links[string_id].most_common(1)[0][0]
+            if link not in seen:
+                seen.add(link)
+                result.append((link, round(float(scores[string_id]), 3), self.strings[string_id]))
+                if len(result) >= limit:
+                    break
+        return result
+
+    def _posting_array(self, feature: str):
+        array = self._arrays.get(feature)
+        if array is None:
+            array = np.array(self.postings[feature], dtype=np.int32)
+            self._arrays[feature] = array
+        return array
+
+    def _size_array(self):
+        if self._sizes is None:
+            self._sizes = np.array(self.sizes, dtype=np.float64)
+        return self._sizes
+
+    def _class_array(self):
+        if self._classes is None:
+            self._classes = np.array(self.classes, dtype=np.int32)
+        return self._classes
@@ -7,6 +7,12 @@ Contains variables with the run-time configuration settings.
 DEBUG = False
 DEMO = False
 LOGGING = False
+PROFILING = False
+LAZY = False
+
+# When serving a shard of the corpus this is a pair with the shard number and
+# the number of shards, set with an argument like 'shard=0/4'
+SHARD = None
 
 # Locations of the source and entity annotation repositories, edit as needed
 SOURCES = '../../../wgbh-collaboration/21'
@@ -14,14 +20,38 @@ ENTITIES = '../../../clams-aapb-annotations/uploads/2022-jun-namedentity/annotat
 
 ANNOTATIONS = '../data/annotations.tab'
 ANNOTATIONS_BACKUP = '../data/annotations-%s.tab'
+DEMO_ANNOTATIONS = '../data/demo-annotations.tab'
+DEMO_ANNOTATIONS_BACKUP = '../data/demo-annotations-%s.tab'
+SHARD_ANNOTATIONS = '../data/annotations-shard-%d-of-%d.tab'
+SHARD_ANNOTATIONS_BACKUP = '../data/annotations-shard-%d-of-%d-%%s.tab'
+LINK_INDEX = '../data/link-index.tab'
 LOGGING_FILE = '../data/log.tab'
+METRICS_FILE = '../data/metrics.json'
+SUMMARY_FILE = '../data/summary.tab'
+SHARD_SUMMARY_FILE = '../data/summary-shard-%d-of-%d.tab'
 
 # Settings for the number of characters in the left and right context, the
-# maximum number of context elements to print for an entity, and the maximum
-# number of annotations to print
+# maximum number of context elements to print for an entity, the maximum
+# number of annotations to print, and the maximum number of rows in the tables
+# with the most frequent unlinked entities and links in the progress pane
 CONTEXT_SIZE = 50
 MAX_CONTEXT_ELEMENTS = 10
 MAX_ANNOTATIONS_DISPLAYED = 25
+MAX_PROGRESS_ROWS = 25
+
+# Maximum number of timing samples kept per timer when profiling, older samples
+# are dropped so memory stays flat during long annotation sessions
+MAX_TIMING_SAMPLES = 10000
+
+# Settings for fuzzy link candidates, the maximum number of candidates shown
+# and the minimum similarity score (between 0 and 1) of a candidate
+MAX_CANDIDATES = 3
+CANDIDATE_THRESHOLD = 0.5
+
+# Number of seconds the annotations writer waits before writing and syncing a
+# batch of annotations, a small delay lets annotations from concurrent sessions
+# share one fsync, with zero only annotations that arrive during a sync do
+COMMIT_DELAY = 0.0
 
 PROMPT = 'ela>'
 URL_PREFIXES = ('http://', 'https://')
@@ -33,7 +63,15 @@ _DOCKER_SETTINGS = {
     'ENTITIES': '/data/clams-aapb-annotations/uploads/2022-jun-namedentity/annotations',
     'ANNOTATIONS': '/data/annotations.tab',
     'ANNOTATIONS_BACKUP': '/data/annotations-%s.tab',
-    'LOGGING_FILE': '/data/log.tab' }
+    'DEMO_ANNOTATIONS': '/data/demo-annotations.tab',
+    'DEMO_ANNOTATIONS_BACKUP': '/data/demo-annotations-%s.tab',
+    'SHARD_ANNOTATIONS': '/data/annotations-shard-%d-of-%d.tab',
+    'SHARD_ANNOTATIONS_BACKUP': '/data/annotations-shard-%d-of-%d-%%s.tab',
+    'LINK_INDEX': '/data/link-index.tab',
+    'LOGGING_FILE': '/data/log.tab',
+    'METRICS_FILE': '/data/metrics.json',
+    'SUMMARY_FILE': '/data/summary.tab',
+    'SHARD_SUMMARY_FILE': '/data/summary-shard-%d-of-%d.tab' }
 
 
 class Warnings(object):
@@ -45,15 +83,46 @@ class Warnings(object):
 
 def update(args):
     """Updates the configuration settings given arguments handed in at startup
-    time, arguments include 'demo', 'debug' and 'docker'."""
-    global DEBUG, DEMO, LOGGING
+    time, arguments include 'demo', 'debug', 'logging', 'profiling', 'lazy',
+    'docker' and 'shard=N/M'."""
+    global DEBUG, DEMO, LOGGING, PROFILING, LAZY, SHARD
     global SOURCES, ENTITIES, ANNOTATIONS, ANNOTATIONS_BACKUP, LOGGING_FILE
+    global METRICS_FILE, SUMMARY_FILE, DEMO_ANNOTATIONS, DEMO_ANNOTATIONS_BACKUP
+    global SHARD_ANNOTATIONS, SHARD_ANNOTATIONS_BACKUP, SHARD_SUMMARY_FILE, LINK_INDEX
     DEBUG = True if 'debug' in args else False
     DEMO = True if 'demo' in args else False
     LOGGING = True if 'logging' in args else False
+    PROFILING = True if 'profiling' in args else False
+    LAZY = True if 'lazy' in args else False
+    SHARD = None
+    for arg in args:
+        if arg.startswith('shard='):
+            shard, shards = arg[6:].split('/')
+            SHARD = (int(shard), int(shards))
+            if not 0 <= SHARD[0] < SHARD[1]:
+                raise ValueError('Shard number out of range in %s' % arg)
     if 'docker' in args:
         SOURCES = _DOCKER_SETTINGS['SOURCES']
         ENTITIES = _DOCKER_SETTINGS['ENTITIES']
         ANNOTATIONS = _DOCKER_SETTINGS['ANNOTATIONS']
         ANNOTATIONS_BACKUP = _DOCKER_SETTINGS['ANNOTATIONS_BACKUP']
         LOGGING_FILE = _DOCKER_SETTINGS['LOGGING_FILE']
+        METRICS_FILE = _DOCKER_SETTINGS['METRICS_FILE']
+        SUMMARY_FILE = _DOCKER_SETTINGS['SUMMARY_FILE']
+        DEMO_ANNOTATIONS = _DOCKER_SETTINGS['DEMO_ANNOTATIONS']
+        DEMO_ANNOTATIONS_BACKUP = _DOCKER_SETTINGS['DEMO_ANNOTATIONS_BACKUP']
+        SHARD_ANNOTATIONS = _DOCKER_SETTINGS['SHARD_ANNOTATIONS']
+        SHARD_ANNOTATIONS_BACKUP = _DOCKER_SETTINGS['SHARD_ANNOTATIONS_BACKUP']
+        SHARD_SUMMARY_FILE = _DOCKER_SETTINGS['SHARD_SUMMARY_FILE']
+        LINK_INDEX = _DOCKER_SETTINGS['LINK_INDEX']
+    # Each shard writes its own annotations and summary, use merge.py to
+    # combine the annotations
+    if SHARD is not None:
+        ANNOTATIONS = SHARD_ANNOTATIONS % SHARD
+        ANNOTATIONS_BACKUP = SHARD_ANNOTATIONS_BACKUP % SHARD
+        SUMMARY_FILE = SHARD_SUMMARY_FILE % SHARD
+    # Demo annotations go to their own store so they never end up in the
+    # real annotations file
+    if DEMO:
+        ANNOTATIONS = DEMO_ANNOTATIONS
+        ANNOTATIONS_BACKUP = DEMO_ANNOTATIONS_BACKUP
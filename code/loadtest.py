@@ -0,0 +1,241 @@
+"""Load test for the annotator
+
+Simulates a number of concurrent annotation sessions against a synthetic
+corpus, in the way Streamlit serves them: one process with a thread for each
+session, where every user action runs a callback and then reruns the script.
+The rerun does what app.py does (load the corpus and annotations, get the next
+entity, compute the status, render contexts and look for suggestions), and
+the actions mirror the callbacks and panes of app.py: accepting a suggested
+link, adding a link, fixing a link, searching annotations and switching to
+the Progress or Messages panes. Links are validated with utils.validate_link
+against a local stub HTTP server.
+
+$ python loadtest.py
+$ python loadtest.py --sessions 8 --actions 50 --files 200 --lazy
+
+Reports throughput, latency percentiles per action and memory use.
+
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import resource
+import tempfile
+import threading
+import http.server
+
+import config
+import model
+import utils
+from stats import CorpusStatistics
+
+
+FIRST_NAMES = ['Jim', 'Robin', 'Judy', 'Gwen', 'Charlayne', 'Roger', 'Margaret', 'Elizabeth']
+LAST_NAMES = ['Lehrer', 'MacNeil', 'Woodruff', 'Ifill', 'Hunter', 'Mudd', 'Warner', 'Farnsworth']
+PLACES = ['Boston', 'New York', 'Washington', 'Chicago', 'Atlanta', 'Denver', 'Seattle', 'Houston']
+ORGANIZATIONS = ['WGBH', 'PBS', 'Congress', 'Senate', 'NASA', 'United Nations', 'NPR', 'CBS']
+FILLER = 'and then we talked about what happened with '
+
+
+def make_corpus(directory: str, files: int = 50, mentions: int = 200, seed: int = 1):
+    """Create a synthetic corpus in the directory, with sources in a sources
+    subdirectory and entity annotations in an annotations subdirectory. Return
+    the paths of the two subdirectories."""
+    random.seed(seed)
+    names = ([('Person', name) for name in FIRST_NAMES + LAST_NAMES]
+             + [('Person', '%s %s' % (first, last))
+                for first in FIRST_NAMES for last in LAST_NAMES]
+             + [('Location', place) for place in PLACES]
+             + [('Organization', org) for org in ORGANIZATIONS])
+    sources = os.path.join(directory, 'sources')
+    annotations = os.path.join(directory, 'annotations')
+    os.makedirs(sources, exist_ok=True)
+    os.makedirs(annotations, exist_ok=True)
+    for n in range(1, files + 1):
+        basename = 'cpb-aacip-999-%010d-transcript' % n
+        text = []
+        lines = []
+        offset = 0
+        for i in range(1, mentions + 1):
+            entity_class, name = random.choice(names)
+            text.append(FILLER)
+            offset += len(FILLER)
+            lines.append('T%d\t%s %d %d\t%s\n' % (i, entity_class, offset, offset + len(name), name))
+            text.append(name + '. ')
+            offset += len(name) + 2
+        with open(os.path.join(sources, basename + '.txt'), 'w') as fh:
+            fh.write(''.join(text))
+        with open(os.path.join(annotations, basename + '.ann'), 'w') as fh:
+            fh.write(''.join(lines))
+    return sources, annotations
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+
+    """Answers 200 for anything under /wiki/ and 404 for everything else."""
+
+    def do_GET(self):
+        self.send_response(200 if self.path.startswith('/wiki/') else 404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Session(object):
+
+    """A simulated user session, the state is what a rerun of app.py creates."""
+
+    def __init__(self, number: int, sources: str, entities: str):
+        self.number = number
+        self.sources = sources
+        self.entities = entities
+        self.random = random.Random(number)
+        self.corpus = None
+        self.link_annotations = None
+        self.entity = None
+        self.suggested_link = None
+
+    def rerun(self):
+        with utils.Metrics.timer('rerun'):
+            self.corpus = model.Corpus(self.entities, self.sources)
+            self.link_annotations = model.LinkAnnotations(self.corpus, config.ANNOTATIONS)
+            self.entity = self.corpus.next()
+            if self.entity is None:
+                return
+            self.corpus.status()
+            self.entity.contexts_as_html(self.corpus, limit=10)
+            self.suggested_link = self.corpus.suggest_link(self.entity.text())
+            if self.suggested_link is None:
+                self.corpus.suggest_candidates(self.entity)
+
+    def act(self):
+        """Pick an action, run it and then rerun."""
+        action = self.random.choice(
+            ['add link', 'add link', 'accept suggestion', 'fix link',
+             'search', 'progress pane', 'messages pane'])
+        if action == 'accept suggestion' and self.suggested_link is None:
+            action = 'add link'
+        if action == 'fix link' and not len(self.link_annotations):
+            action = 'add link'
+        if self.entity is None and action in ('add link', 'accept suggestion'):
+            action = 'search'
+        with utils.Metrics.timer(action):
+            getattr(self, action.replace(' ', '_'))()
+            self.rerun()
+
+    def add_link(self, link=None):
+        if link is None:
+            link = self.entity.text() if self.random.random() < 0.9 else ''
+        self.validate_and_add(self.entity, self.link_annotations.normalize_link(link), '')
+
+    def accept_suggestion(self):
+        self.add_link(self.suggested_link)
+
+    def fix_link(self):
+        annotation = self.random.choice(self.link_annotations.annotations)
+        fname = annotation.file_name[:-15]
+        entity = self.corpus.get_entity(annotation.text, fname)
+        link = self.link_annotations.normalize_link(annotation.text + ' (fixed)')
+        self.validate_and_add(entity, link, 'fixed by session %d' % self.number)
+
+    def validate_and_add(self, entity, link, comment):
+        with utils.Metrics.timer('validate link'):
+            is_valid = utils.validate_link(link)
+        if is_valid:
+            entity.link = link
+            entity.comment = comment
+            self.link_annotations.add_link(entity, link, comment)
+
+    def search(self):
+        term = self.random.choice(LAST_NAMES + PLACES)
+        annotations = list(reversed(self.link_annotations.search(term)))
+        utils.annotations_as_table(annotations[:config.MAX_ANNOTATIONS_DISPLAYED])
+
+    def progress_pane(self):
+        statistics = CorpusStatistics.get(self.corpus, self.link_annotations)
+        statistics.corpus_summary()
+        statistics.per_class()
+        statistics.top_unlinked(config.MAX_PROGRESS_ROWS)
+        statistics.link_distribution(config.MAX_PROGRESS_ROWS)
+        statistics.per_file()
+
+    def messages_pane(self):
+        list(utils.Messages.messages)
+
+
+def memory_usage():
+    """Return the current and peak resident set size in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+    current = None
+    try:
+        with open('/proc/self/statm') as fh:
+            current = int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except OSError:
+        pass
+    return current, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sessions', type=int, default=4)
+    parser.add_argument('--actions', type=int, default=25, help='actions per session')
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--mentions', type=int, default=200, help='entity mentions per file')
+    parser.add_argument('--lazy', action='store_true')
+    args = parser.parse_args()
+    server = start_stub_server()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sources, entities = make_corpus(tmpdir, args.files, args.mentions)
+        config.update(['profiling'] + (['lazy'] if args.lazy else []))
+        config.ANNOTATIONS = os.path.join(tmpdir, 'annotations.tab')
+        config.SUMMARY_FILE = os.path.join(tmpdir, 'summary.tab')
+        config.WIKIPEDIA_LINK = 'http://127.0.0.1:%d/wiki/%%s' % server.server_port
+        sessions = [Session(n, sources, entities) for n in range(args.sessions)]
+        for session in sessions:
+            session.rerun()
+        utils.Metrics.reset()
+        memory_before, _ = memory_usage()
+
+        def run_session(session):
+            for _ in range(args.actions):
+                session.act()
+
+        threads = [threading.Thread(target=run_session, args=(s,)) for s in sessions]
+        t0 = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - t0
+    server.shutdown()
+    memory_after, memory_peak = memory_usage()
+    actions = args.sessions * args.actions
+    print('sessions=%d actions=%d files=%d mentions=%d lazy=%s\n'
+          % (args.sessions, actions, args.files, args.mentions, args.lazy))
+    print('throughput: %.1f actions/sec (%.1f sec)\n' % (actions / elapsed, elapsed))
+    print('%-18s %6s %9s %9s %9s %9s %9s'
+          % ('action', 'count', 'mean', 'p50', 'p90', 'p99', 'max'))
+    for row in utils.Metrics.timer_summary():
+        print('%-18s %6d %9.2f %9.2f %9.2f %9.2f %9.2f' % tuple(row))
+    print('\nlatencies in milliseconds, actions include the rerun that follows them\n')
+    if memory_before is not None:
+        print('memory: %.1f MB before, %.1f MB after, %.1f MB peak'
+              % (memory_before, memory_after, memory_peak))
+    else:
+        print('memory: %.1f MB peak' % memory_peak)
+
+
+if __name__ == '__main__':
+    main()
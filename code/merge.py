@@ -0,0 +1,94 @@
+"""Merge annotation logs from shards
+
+When the corpus is served by several annotator instances, each started with a
+'shard=N/M' argument, every instance writes its own annotations file. This
+script merges those files into one annotations file and/or builds the link
+index that the instances read to share links with each other.
+
+$ python merge.py --output ../data/annotations.tab ../data/annotations-shard-*.tab
+$ python merge.py --index ../data/link-index.tab ../data/annotations-shard-*.tab
+
+Merged annotations are ordered on timestamp, with ties broken by the order of
+the input files and then the original identifiers, and are then renumbered
+starting at 1. An existing output file is only overwritten with --force, it
+may be one of the inputs.
+
+The index only has the current link for each entity type. To keep the index
+fresh while annotators are working, run the second command periodically (see
+scripts/shards.sh).
+
+"""
+
+import os
+import sys
+import argparse
+import collections
+
+import storage
+from model import LinkAnnotation
+
+
+def read_annotations(file_names: list) -> list:
+    """Return the valid annotations from all files in merge order. The files
+    are not changed since the shards may still be writing to them."""
+    keyed = []
+    for file_number, file_name in enumerate(file_names):
+        for line in storage.AnnotationLog(file_name).read(recover=False):
+            annotation = LinkAnnotation(line)
+            if annotation.is_valid:
+                keyed.append(((annotation.timestamp, file_number, annotation.identifier), annotation))
+    keyed.sort(key=lambda pair: pair[0])
+    return [annotation for _key, annotation in keyed]
+
+
+def merge(annotations: list, output: str):
+    """Renumber the annotations and write them to the output file. The file
+    is replaced in one go so a crash never leaves a partial merge."""
+    tmp_file = output + '.tmp'
+    with open(tmp_file, 'w', encoding='utf8') as fh:
+        for identifier, annotation in enumerate(annotations, start=1):
+            annotation.identifier = identifier
+            fh.write(storage.add_checksum(annotation.as_tab_separated_line()) + '\n')
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_file, output)
+
+
+def build_index(annotations: list, index: str):
+    """Write the link index for the current link of each entity type."""
+    current = {}
+    for annotation in annotations:
+        current[(annotation.file_name, annotation.text)] = annotation
+    links = {}
+    for annotation in current.values():
+        if annotation.link:
+            key = (annotation.text, annotation.entity_class)
+            links.setdefault(key, collections.Counter())[annotation.link] += 1
+    storage.LinkIndex.write(index, links)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('inputs', nargs='+', help='annotation files of the shards')
+    parser.add_argument('--output', help='merged annotations file')
+    parser.add_argument('--index', help='link index file')
+    parser.add_argument('--force', action='store_true', help='overwrite the output file')
+    args = parser.parse_args()
+    if args.output is None and args.index is None:
+        parser.error('nothing to do, use --output and/or --index')
+    if args.output and os.path.exists(args.output) and not args.force:
+        sys.exit('%s exists, use --force to overwrite it' % args.output)
+    missing = [file_name for file_name in args.inputs if not os.path.exists(file_name)]
+    if missing:
+        sys.exit('no such file: %s' % ', '.join(missing))
+    annotations = read_annotations(args.inputs)
+    if args.index:
+        build_index(annotations, args.index)
+        print('Wrote index for %d annotations to %s' % (len(annotations), args.index))
+    if args.output:
+        merge(annotations, args.output)
+        print('Merged %d annotations into %s' % (len(annotations), args.output))
+
+
+if __name__ == '__main__':
+    main()
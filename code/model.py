@@ -7,14 +7,15 @@ and annotations in those files.
 """
 
 import os
-import copy
+import zlib
 import shutil
-import pathlib
+import threading
 import collections
 from io import StringIO
 
 import config
-from utils import timestamp
+from utils import timestamp, Metrics
+from storage import AnnotationLog, LinkIndex
 
 
 class Corpus(object):
@@ -24,53 +25,82 @@ class Corpus(object):
 
     annotations_folder  -  location of the annotations
     sources_folder      -  location of the sources
+    lazy                -  if True files are only parsed when first used
     files               -  { filename => File }
     sources             -  { filename => file-content: str }
+    source_paths        -  { filename => file-path: str }
+    candidate_index     -  CandidateIndex over linked entities, built on demand
+                           and shared with other Corpus instances in the process
+    link_index          -  LinkIndex with links from all shards, or None
+
+    In lazy mode the sources dictionary stays empty and files read their source
+    from the path in source_paths when it is first needed.
+
+    When a shard is configured only the annotation files in that shard and
+    their sources are loaded and the link index is used for suggestions.
 
     """
 
-    def __init__(self, annotations_folder: str, sources_folder: str):
+    def __init__(self, annotations_folder: str, sources_folder: str, lazy=None):
         """Create a corpus from a set of sources and a set of annotations."""
         self.annotations_folder = annotations_folder
         self.sources_folder = sources_folder
+        self.lazy = config.LAZY if lazy is None else lazy
         self.files = {}
         self.sources = {}
+        self.source_paths = {}
+        self.candidate_index = None
+        self.link_index = LinkIndex.load(config.LINK_INDEX) if config.SHARD else None
         self._read_sources()
         self._read_annotations()
         self._add_dummy_data()
 
     def _read_sources(self):
         """Read all the primary sources. They are first stored on the Corpus
-        instance and then later also imported into all File instances."""
+        instance and then later also imported into all File instances. When a
+        shard is configured only sources of annotation files in the shard are
+        read."""
         for fname in os.listdir(self.sources_folder):
             if len(fname) == 39:
                 basename = os.path.splitext(fname)[0]
+                if config.SHARD is not None and not in_shard(basename + '.ann', *config.SHARD):
+                    continue
                 fpath = os.path.join(self.sources_folder, fname)
-                with open(fpath) as fh:
-                    self.sources[basename] = fh.read()
+                self.source_paths[basename] = fpath
+                if not self.lazy:
+                    with open(fpath) as fh:
+                        self.sources[basename] = fh.read()
 
     def _read_annotations(self):
         """Read the annotations over the primary sources. This is for the named
         entity annotations that are input to the linking process. Annotations
-        are stored in File instances, which also get the source text added."""
+        are stored in File instances, which also get the source text added. In
+        lazy mode files are not parsed, instead they get their entity type
+        count from the summary file."""
+        summary = Summary(config.SUMMARY_FILE) if self.lazy else None
         for fname in sorted(os.listdir(self.annotations_folder)):
+            if config.SHARD is not None and not in_shard(fname, *config.SHARD):
+                continue
             fpath = os.path.join(self.annotations_folder, fname)
-            corpus_file = File(fname, fpath)
             basename = os.path.splitext(fname)[0]
-            corpus_file.source = self.sources.get(basename, '')
+            if self.lazy:
+                corpus_file = File(fname, fpath, lazy=True,
+                                   type_count=summary.type_count(fname, fpath))
+                corpus_file.source_path = self.source_paths.get(basename)
+            else:
+                corpus_file = File(fname, fpath)
+                corpus_file.source = self.sources.get(basename, '')
             self.files[fname] = corpus_file
+        if summary is not None:
+            summary.save()
 
     def _add_dummy_data(self):
         """Create a dummy file from an existing file, using only the most common
         entities from the existing file. Then add it to the beginning of the file
-        list. This is for demonstrating the tool."""
-        def add_entity(dummy_file, source_file, etype):
-            dummy_file.source = source_file.source
-            dummy_entity = copy.deepcopy(etype)
-            dummy_entity.file_name = dummy_file.name
-            for token in dummy_entity:
-                token.file_name = dummy_file.name
-            dummy_file.data[entity_type.text()] = dummy_entity
+        list. This is for demonstrating the tool. The entity types in the dummy
+        files are views that share their tokens with the entity types in the
+        existing file, the tokens still point at the existing file, which has
+        the same source and is therefore used for contexts."""
         if config.DEMO:
             file_names = self.get_file_names()
             dummy1_file_name = 'cpb-aacip-000-0000000001-transcript.ann'
@@ -78,14 +108,14 @@ class Corpus(object):
             first_file = self.files.get(file_names[0])
             dummy1_file = File(dummy1_file_name)
             dummy2_file = File(dummy2_file_name)
+            for dummy_file in (dummy1_file, dummy2_file):
+                dummy_file.source_path = first_file.source_path
+                dummy_file.source = first_file.source
             for entity_text, entity_type in first_file.data.items():
-                if not len(entity_type) > 2:
-                    continue
-                # utils.Messages.debug('>>> (_add_dummy_data) %s' % entity_type)
                 if len(entity_type) > 5:
-                    add_entity(dummy1_file, first_file, entity_type)
+                    dummy1_file.data[entity_text] = entity_type.view(dummy1_file_name)
                 if len(entity_type) > 2:
-                    add_entity(dummy2_file, first_file, entity_type)
+                    dummy2_file.data[entity_text] = entity_type.view(dummy2_file_name)
             self.files[dummy1_file_name] = dummy1_file
             self.files[dummy2_file_name] = dummy2_file
 
@@ -101,7 +131,8 @@ class Corpus(object):
         return list(sorted(self.files))
 
     def get_entity(self, text: str, fname: str):
-        """Return the EntityType for the text in file fname."""
+        """Return the EntityType for the text in file fname. In lazy mode
+        this parses the file if that did not happen yet."""
         file = self.files.get(fname + '-transcript.ann')
         entity = file.data.get(text)
         return entity
@@ -111,26 +142,84 @@ class Corpus(object):
                 ['ENTITIES', self.annotations_folder]]
 
     def next(self):
-        """Return the first un-annotated entity."""
+        """Return the first un-annotated entity. Files that are known to be
+        done are skipped without parsing them."""
         for corpus_file in self.get_files():
+            if corpus_file.unlinked_count() == 0:
+                continue
             for type_entity in corpus_file.data.values():
                 if type_entity.link is None:
                     return type_entity
 
     def suggest_link(self, entity_text: str):
         """Given an entity, suggest a possible link by looking at previously
-        annotated entities."""
+        annotated entities. If there are none in this corpus then look in the
+        link index if there is one."""
         suggestions = []
         for corpus_file in self.get_files():
-            suggestion = corpus_file.data.get(entity_text)
-            if suggestion is not None and suggestion.link is not None:
-                suggestions.append(suggestion.link)
+            suggestion = corpus_file.links.get(entity_text)
+            if suggestion is not None:
+                suggestions.append(suggestion[1])
         c = collections.Counter(suggestions)
         try:
             return c.most_common()[0][0]
         except IndexError:
+            if self.link_index is not None:
+                return self.link_index.suggest(entity_text)
             return None
 
+    def suggest_candidates(self, entity_type, limit=config.MAX_CANDIDATES):
+        """Given an entity type, return a list of (link, score, text) triples
+        for linked entities of the same class whose text is similar to the
+        text of the entity type."""
+        if self.candidate_index is None:
+            self.candidate_index = self._get_candidate_index()
+        return self.candidate_index.candidates(
+            entity_type.text(), entity_class=entity_type.entity_class(),
+            limit=limit, threshold=config.CANDIDATE_THRESHOLD)
+
+    def index_link(self, entity_type, link: str, previous_link: str = None):
+        """Add a new link to the candidate index, if one was built in this
+        process, replacing the previous link of the entity type if given."""
+        with Corpus._candidate_indexes_lock:
+            index = Corpus._candidate_indexes.get(self._candidate_index_key())
+        if index is not None:
+            if previous_link is not None:
+                index.remove(entity_type.text(), entity_type.entity_class(), previous_link)
+            index.add(entity_type.text(), entity_type.entity_class(), link)
+
+    # Candidate indexes are slow to build and Streamlit creates a new Corpus
+    # on every rerun, so the index is kept for the process and new links are
+    # added to it with index_link()
+    _candidate_indexes = {}
+    _candidate_indexes_lock = threading.Lock()
+
+    def _candidate_index_key(self):
+        link_index_mtime = None if self.link_index is None else self.link_index.mtime
+        return (self.annotations_folder, os.path.abspath(config.ANNOTATIONS),
+                config.SHARD, link_index_mtime)
+
+    def _get_candidate_index(self):
+        # imported here because it imports numpy, which is slow to import
+        from candidates import CandidateIndex
+        key = self._candidate_index_key()
+        with Corpus._candidate_indexes_lock:
+            index = Corpus._candidate_indexes.get(key)
+            if index is not None:
+                Metrics.count('candidate index cache hits')
+            else:
+                Metrics.count('candidate index cache misses')
+                index = CandidateIndex()
+                if self.link_index is not None:
+                    for (text, entity_class), links in self.link_index.links.items():
+                        for link in links:
+                            index.add(text, entity_class, link)
+                for corpus_file in self.get_files():
+                    for text, (entity_class, link) in corpus_file.links.items():
+                        index.add(text, entity_class, link)
+                Corpus._candidate_indexes = {key: index}
+        return index
+
     def status(self):
         corpus_types = 0
         corpus_types_done = 0
@@ -146,34 +235,93 @@ class Corpus(object):
         return corpus_types, corpus_percentage_done, result
 
 
+def in_shard(file_name: str, shard: int, shards: int) -> bool:
+    """Return True if the file belongs to the shard, files are assigned to
+    shards by a hash of their name."""
+    return zlib.crc32(file_name.encode('utf8')) % shards == shard
+
+
 class File(object):
 
     """Stores all annotations for a file as well as the text source.
 
-    name: str    -  the file name
-    path: str    -  the relative path to the file
-    source: str  -  source text for the file
-    data: dict   -  { entity-text => EntityType }
+    name: str         -  the file name
+    path: str         -  the relative path to the file
+    source: str       -  source text for the file
+    source_path: str  -  path to the source text, used when source is not set
+    data: dict        -  { entity-text => EntityType }
+    links: dict       -  { entity-text => (entity-class, link) }
+
+    A lazy file does not parse the annotation file until data is first used,
+    until then it relies on the type count handed in and on the links dictionary
+    for its status. Links set before parsing are added to the entity types when
+    the file is parsed.
 
     """
 
-    def __init__(self, file_name, file_path=None):
+    def __init__(self, file_name, file_path=None, lazy=False, type_count=None):
         self.name = file_name
         self.path = file_path
-        self.source = None
-        self.data = {}
+        self.source_path = None
+        self.links = {}
+        self._source = None
+        self._data = {}
+        self._type_count = type_count
         if file_path is not None:
-            for line in open(file_path):
-                entity = Entity(file_name, line)
-                self.data.setdefault(entity.text, EntityType(file_name)).append(entity)
+            if lazy:
+                self._data = None
+            else:
+                self._parse()
 
     def __str__(self):
-        return "<File %s %s>" % (self.name, len(self.data))
+        return "<File %s %s>" % (self.name, self.entity_type_count())
+
+    @property
+    def source(self):
+        if self._source is None and self.source_path is not None:
+            with open(self.source_path) as fh:
+                self._source = fh.read()
+        return '' if self._source is None else self._source
+
+    @source.setter
+    def source(self, text: str):
+        self._source = text
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._parse()
+        return self._data
+
+    def _parse(self):
+        self._data = {}
+        for line in open(self.path):
+            entity = Entity(self.name, line)
+            self._data.setdefault(entity.text, EntityType(self.name)).append(entity)
+        for text, (_entity_class, link) in self.links.items():
+            if text in self._data:
+                self._data[text].link = link
+
+    def is_parsed(self) -> bool:
+        return self._data is not None
+
+    def set_link(self, text: str, entity_class: str, link: str):
+        """Record the link for an entity text, this is also handed to the
+        entity type if the file was parsed already."""
+        self.links[text] = (entity_class, link)
+        if self._data is not None and text in self._data:
+            self._data[text].link = link
 
     def entity_type_count(self):
         """Return the number of entities in the file."""
+        if self._data is None and self._type_count is not None:
+            return self._type_count
         return len(self.data)
 
+    def unlinked_count(self):
+        """Return the number of entities in the file that have no link yet."""
+        return self.entity_type_count() - len(self.links)
+
     def entity_token_count(self):
         """Return the number of entity tokens in the file."""
         return sum([len(x) for x in self.data.values()])
@@ -193,12 +341,7 @@ class File(object):
     def status(self) -> tuple:
         """Return the total number of entity types, the number of entity types
         done and the percentage done for entity types."""
-        done_types = 0
-        done_tokens = 0
-        for entity_type in self.data.values():
-            if entity_type.link is not None:
-                done_types += 1
-                done_tokens += len(entity_type)
+        done_types = len(self.links)
         percent_done_types = (done_types * 100 / self.entity_type_count())
         return self.entity_type_count(), done_types, percent_done_types
 
@@ -210,6 +353,56 @@ class File(object):
                 print("%3d  %s" % (count, text))
 
 
+class Summary(object):
+
+    """Precomputed entity type counts for annotation files, so a lazy corpus
+    can report progress without parsing the files. The summary is stored as a
+    tab-separated file with the file name, size, modification time and number
+    of entity types, entries are recomputed when size or time have changed.
+    Lines that cannot be parsed are skipped, their entries are recomputed.
+
+    summary_file: str  -  location of the summary file
+    entries: dict      -  { filename => (size, mtime, type-count) }
+    changed: bool      -  True if entries were added or updated
+
+    """
+
+    def __init__(self, summary_file: str):
+        self.summary_file = summary_file
+        self.entries = {}
+        self.changed = False
+        if os.path.exists(summary_file):
+            with open(summary_file) as fh:
+                for line in fh:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) == 4 and all(f.isdigit() for f in fields[1:]):
+                        self.entries[fields[0]] = (int(fields[1]), int(fields[2]), int(fields[3]))
+
+    def type_count(self, file_name: str, file_path: str) -> int:
+        """Return the number of entity types in the file, only scanning the
+        file if the summary has no valid entry for it."""
+        stat = os.stat(file_path)
+        entry = self.entries.get(file_name)
+        if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+            return entry[2]
+        with open(file_path) as fh:
+            count = len({line.strip().split('\t')[-1] for line in fh if line.strip()})
+        self.entries[file_name] = (stat.st_size, stat.st_mtime_ns, count)
+        self.changed = True
+        return count
+
+    def save(self):
+        if self.changed:
+            # sessions may save at the same time, so each uses its own tmp file
+            tmp_file = '%s.%d.%d.tmp' % (self.summary_file, os.getpid(), threading.get_ident())
+            with open(tmp_file, 'w') as fh:
+                for file_name in sorted(self.entries):
+                    size, mtime, count = self.entries[file_name]
+                    fh.write('%s\t%d\t%d\t%d\n' % (file_name, size, mtime, count))
+            os.replace(tmp_file, self.summary_file)
+            self.changed = False
+
+
 class Entity(object):
 
     """An entity instance, corresponding to an annotation.
@@ -280,6 +473,13 @@ class EntityType(object):
         """Append the Entity to the token list."""
         self.tokens.append(item)
 
+    def view(self, file_name: str):
+        """Return a new EntityType for another file that shares the token list
+        with this one but has its own link."""
+        entity_type = EntityType(file_name)
+        entity_type.tokens = self.tokens
+        return entity_type
+
     def text(self) -> str:
         """The text of the entity, taken from the first token."""
         return self.tokens[0].text
@@ -337,9 +537,14 @@ class LinkAnnotation(object):
     """
 
     def __init__(self, line):
-        """Always initialize from a line with tab-separated fields."""
+        """Always initialize from a line with tab-separated fields. If the line
+        does not have enough fields or the numbers are not numbers then the
+        annotation is not valid and has no text, link or comment."""
         fields = line.strip('\n').strip(' ').split('\t')
-        self.is_valid = True if len(fields) >= 7 else False
+        self.is_valid = (len(fields) >= 7
+                         and fields[0].isdigit() and fields[5].isdigit())
+        if not self.is_valid:
+            fields = ['0', None, None, None, None, '0', None]
         self.identifier = int(fields[0])
         self.timestamp = fields[1]
         self.file_name = fields[2]
@@ -382,9 +587,15 @@ class LinkAnnotations(object):
     number of tokens for the entity, and the entity link.
 
     corpus: Corpus         -  Corpus that the annotations are over
-    annotations: list      -  list of instances of LinkAnnotation
-    annotation_id: int     -  keeps track of identifier for the next annotation
+    current: dict          -  { (file name, entity text) => LinkAnnotation }
     annotations_file: str  -  file with all saved annotations
+    log: AnnotationLog     -  durable writer and reader for the annotations file
+
+    Only the most recent annotation of each entity type is kept in memory, in
+    the order in which they were last updated. Earlier annotations of an entity
+    type are still in the annotations file and can be retrieved with history().
+    Identifiers for new annotations are handed out by the log, since it is
+    shared by all sessions.
 
     """
 
@@ -392,17 +603,25 @@ class LinkAnnotations(object):
         """Initialize from a Corpus and the standard annotations file with
         previously saved annotations."""
         self.corpus = corpus
-        self.annotations = []
-        self.annotation_id = 0
+        self.current = {}
         self.annotations_file = annotations_file
+        self.log = AnnotationLog.get(annotations_file)
         self._load_annotations()
 
     def __str__(self):
-        return '<LinkAnnotations annotations=%s>' % len(self.annotations)
+        return '<LinkAnnotations annotations=%s>' % len(self.current)
+
+    def __len__(self):
+        return len(self.current)
 
     def __getitem__(self, item):
         return self.annotations[item]
 
+    @property
+    def annotations(self) -> list:
+        """The current annotations, the most recently updated one last."""
+        return list(self.current.values())
+
     @classmethod
     def is_link(cls, link: str) -> bool:
         """Return True if the link string starts with 'http://' or 'https://',
@@ -422,43 +641,63 @@ class LinkAnnotations(object):
         return link if cls.is_link(link) else config.WIKIPEDIA_LINK % link
 
     def _load_annotations(self):
-        pathlib.Path(self.annotations_file).touch(exist_ok=True)
-        with open(self.annotations_file) as fh:
-            for line in fh:
-                annotation = LinkAnnotation(line)
-                if annotation.is_valid:
-                    self.add_annotation(annotation)
+        for line in self.log.read():
+            annotation = LinkAnnotation(line)
+            if annotation.is_valid:
+                self.add_annotation(annotation)
 
     def add_annotation(self, annotation: LinkAnnotation):
         """Add a link annotation to the list of annotations and to the entity
         that it is created for."""
         if not config.DEMO and annotation.is_dummy_annotation():
             return
-        self.annotation_id = max(self.annotation_id, annotation.identifier)
-        self.annotations.append(annotation)
+        self._update_current(annotation)
         corpus_file = self.corpus.files.get(annotation.file_name)
-        corpus_file.data.get(annotation.text).link = annotation.link
+        corpus_file.set_link(annotation.text, annotation.entity_class, annotation.link)
+
+    def _update_current(self, annotation: LinkAnnotation):
+        """Make the annotation the current one for its entity type, replacing
+        and moving to the end any annotation that was there before."""
+        key = (annotation.file_name, annotation.text)
+        self.current.pop(key, None)
+        self.current[key] = annotation
 
     def get_annotation(self, identifier: int):
-        """Return None or the annotation that matches the identifier."""
-        for a in self.annotations:
+        """Return None or the current annotation that matches the identifier."""
+        for a in self.current.values():
             if a.identifier == identifier:
                 return a
         return None
 
+    def history(self, file_name: str, text: str) -> list:
+        """Return all annotations ever made for the entity type with the given
+        file name and text, oldest first. These are read from the annotations
+        file since only the current annotations are kept in memory."""
+        result = []
+        for line in self.log.read():
+            annotation = LinkAnnotation(line)
+            if (annotation.is_valid and annotation.file_name == file_name
+                    and annotation.text == text):
+                result.append(annotation)
+        return result
+
     def add_link(self, entity, link, comment):
         """Create an instance of LinkAnnotation and save it."""
         annotation_list = self.create_link(link, entity=entity, comment=comment)
         annotation_str = '\t'.join([str(f) for f in annotation_list])
         annotation_obj = LinkAnnotation(annotation_str)
         self.save_annotation(annotation_obj)
+        corpus_file = self.corpus.files.get(entity.file_name)
+        previous = corpus_file.links.get(entity.text())
+        corpus_file.set_link(entity.text(), entity.entity_class(), link)
+        self.corpus.index_link(entity, link, previous[1] if previous else None)
 
     def create_link(self, link, entity=None, comment=None, annotation=None) -> list:
         """Create a new link annotation. If an existing annotation is handed in
         we use that to set some of the new annotation's values, otherwise we use
-        the information from the current entity."""
-        self.annotation_id += 1
-        anno_id = str(self.annotation_id)
+        the information from the current entity. The identifier is 0 until the
+        annotation is saved."""
+        anno_id = '0'
         ts = timestamp()
         (fname, text, e_class, e_len) = (None, None, None, None)
         if entity is not None:
@@ -476,11 +715,12 @@ class LinkAnnotations(object):
         return specs
 
     def save_annotation(self, annotation: LinkAnnotation):
-        """Append the annotation to the annotations list and write it to the
-        annotations file."""
-        self.annotations.append(annotation)
-        with open(self.annotations_file, 'a') as fh:
-            fh.write('%s\n' % annotation.as_tab_separated_line())
+        """Append the annotation to the annotations file and make it the
+        current one for its entity type, this returns when the annotation is
+        safely on disk and has its identifier."""
+        fields = [str(f) for f in annotation.fields()[1:]]
+        annotation.identifier = self.log.append('\t'.join(fields))
+        self._update_current(annotation)
 
     def backup(self) -> str:
         source_file = self.annotations_file
@@ -489,10 +729,10 @@ class LinkAnnotations(object):
         return target_file
 
     def search(self, search_term: str):
-        """Returns a list of all the annotations where the search term occurs
-        in the text. The search us case-insensitive."""
+        """Returns a list of all the current annotations where the search term
+        occurs in the text. The search us case-insensitive."""
         result = []
-        for annotation in self:
+        for annotation in self.current.values():
             if search_term.lower() in annotation.text.lower():
                 result.append(annotation)
         return result
@@ -0,0 +1,178 @@
+"""Corpus statistics
+
+Columnar statistics over all entities and link annotations, used by the
+Progress pane. The entity types of the corpus, with their number of tokens,
+are put in a pandas table once, after that only the link state of entity types
+changes, which is updated from new lines in the annotations file. All
+breakdowns are computed with vectorized operations over that table.
+
+Building the table needs the entity types of all files, so in lazy mode the
+first use of the statistics parses the whole corpus. This is a known cost, it
+is paid once per process since the statistics are cached.
+
+"""
+
+import threading
+
+import numpy as np
+import pandas as pd
+
+from model import LinkAnnotation
+from utils import Metrics
+
+
+UNLINKED = 0
+LINKED = 1
+EMPTY = 2
+STATES = ['unlinked', 'linked', 'empty']
+
+
+class CorpusStatistics(object):
+
+    """Statistics over a corpus and its link annotations.
+
+    types: DataFrame       -  one row per entity type with file, text, class,
+                              number of tokens, link and state
+    positions: dict        -  { (file name, entity text) => row in types }
+    position: int          -  offset in the annotations file up to where the
+                              annotations were applied
+
+    The state of an entity type is UNLINKED, LINKED or EMPTY, where EMPTY is
+    used for entity types that were annotated with an empty link.
+
+    Statistics are shared by all sessions in a process, so building them and
+    applying annotations are done under a lock.
+
+    """
+
+    _cache = {}
+    _cache_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, corpus, link_annotations):
+        """Return statistics for the corpus, brought up to date with the link
+        annotations. Statistics are reused for as long as the corpus has the
+        same files and annotations file, which saves rebuilding them on every
+        rerun."""
+        key = (corpus.annotations_folder, tuple(corpus.get_file_names()),
+               link_annotations.annotations_file)
+        with cls._cache_lock:
+            statistics = cls._cache.get(key)
+            if statistics is not None:
+                Metrics.count('statistics cache hits')
+            else:
+                Metrics.count('statistics cache misses')
+                statistics = cls(corpus)
+                cls._cache = {key: statistics}
+        statistics.sync(link_annotations)
+        return statistics
+
+    def __init__(self, corpus):
+        file_names = corpus.get_file_names()
+        type_files, type_texts, type_classes, type_tokens = [], [], [], []
+        self.positions = {}
+        for file_number, corpus_file in enumerate(corpus.get_files()):
+            for text, entity_type in corpus_file.data.items():
+                self.positions[(corpus_file.name, text)] = len(type_texts)
+                type_files.append(file_number)
+                type_texts.append(text)
+                type_classes.append(entity_type.entity_class())
+                type_tokens.append(len(entity_type))
+        self.types = pd.DataFrame({
+            'file': pd.Categorical.from_codes(type_files, file_names),
+            'text': pd.Categorical(type_texts),
+            'class': pd.Categorical(type_classes, categories=sorted(set(type_classes))),
+            'tokens': np.array(type_tokens, dtype=np.int64),
+            'link': pd.Series([None] * len(type_texts), dtype=object),
+            'state': np.zeros(len(type_texts), dtype=np.int8)})
+        self.position = 0
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return '<CorpusStatistics types=%d tokens=%d>' % (len(self.types), self.types['tokens'].sum())
+
+    def sync(self, link_annotations):
+        """Apply all link annotations that were written to the annotations file
+        since the last sync, in the order of the file. This uses the position
+        in the file and not identifiers, so it does not matter which session
+        wrote an annotation."""
+        with self._lock:
+            lines, position = link_annotations.log.read_from(self.position)
+            for line in lines:
+                annotation = LinkAnnotation(line)
+                if annotation.is_valid:
+                    self._update(annotation.file_name, annotation.text, annotation.link)
+            self.position = position
+
+    def update(self, file_name: str, text: str, link: str):
+        """Set the link of an entity type, this is a no-op for entity types
+        that are not in the corpus."""
+        with self._lock:
+            self._update(file_name, text, link)
+
+    def _update(self, file_name: str, text: str, link: str):
+        position = self.positions.get((file_name, text))
+        if position is not None:
+            state = UNLINKED if link is None else (LINKED if link else EMPTY)
+            self.types.iat[position, self.types.columns.get_loc('link')] = link
+            self.types.iat[position, self.types.columns.get_loc('state')] = state
+
+    def corpus_summary(self) -> pd.DataFrame:
+        """Return numbers of types and tokens for each link state."""
+        codes = np.zeros(len(self.types), dtype=np.int64)
+        return self._breakdown('', codes, ['corpus'])
+
+    def per_class(self) -> pd.DataFrame:
+        """Return numbers of types and tokens for each link state for each
+        entity class."""
+        column = self.types['class'].cat
+        return self._breakdown('class', column.codes.to_numpy(), list(column.categories))
+
+    def per_file(self) -> pd.DataFrame:
+        """Return numbers of types and tokens for each link state for each
+        file."""
+        column = self.types['file'].cat
+        labels = [name.replace('-transcript.ann', '') for name in column.categories]
+        return self._breakdown('file', column.codes.to_numpy(), labels)
+
+    def _breakdown(self, name: str, codes, labels: list) -> pd.DataFrame:
+        """Count types and tokens for each combination of a group code and a
+        state, with one bincount over the combined codes."""
+        cells = codes.astype(np.int64) * len(STATES) + self.types['state'].to_numpy()
+        size = len(labels) * len(STATES)
+        types = np.bincount(cells, minlength=size).reshape(-1, len(STATES))
+        tokens = np.bincount(cells, weights=self.types['tokens'].to_numpy(),
+                             minlength=size).reshape(-1, len(STATES)).astype(np.int64)
+        total_types = types.sum(axis=1)
+        table = pd.DataFrame({name: labels, 'types': total_types, 'tokens': tokens.sum(axis=1)})
+        for state, state_name in enumerate(STATES):
+            table['%s types' % state_name] = types[:, state]
+            table['%s tokens' % state_name] = tokens[:, state]
+        done = total_types - types[:, UNLINKED]
+        table['% done'] = np.round(100 * done / np.maximum(total_types, 1))
+        return table
+
+    def top_unlinked(self, limit: int = 25) -> pd.DataFrame:
+        """Return the unlinked entity strings with the most tokens and the
+        number of files they are unlinked in."""
+        column = self.types['text'].cat
+        unlinked = self.types['state'].to_numpy() == UNLINKED
+        codes = column.codes.to_numpy()[unlinked]
+        size = len(column.categories)
+        tokens = np.bincount(codes, weights=self.types['tokens'].to_numpy()[unlinked],
+                             minlength=size).astype(np.int64)
+        files = np.bincount(codes, minlength=size)
+        top = np.argsort(-tokens, kind='stable')[:limit]
+        top = top[tokens[top] > 0]
+        return pd.DataFrame({'text': column.categories[top], 'tokens': tokens[top],
+                             'files': files[top]})
+
+    def link_distribution(self, limit: int = 25) -> pd.DataFrame:
+        """Return the links that were used for the most entity tokens, with
+        the number of entity types and different strings for each link."""
+        linked = self.types[self.types['state'] == LINKED]
+        table = (linked.groupby('link', sort=False)
+                 .agg(types=('text', 'size'), strings=('text', 'nunique'),
+                      tokens=('tokens', 'sum'))
+                 .sort_values('tokens', ascending=False, kind='stable'))
+        return table.head(limit).reset_index()
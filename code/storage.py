@@ -0,0 +1,341 @@
+"""Durable storage of link annotations
+
+The annotations file is an append-only log with one annotation per line. Each
+line written by this module has the eight fields of an annotation followed by
+a ninth field with a CRC32 checksum of the rest of the line. Lines with fewer
+fields were written by older versions of the tool and are accepted as they
+are, whatever their last field looks like.
+
+The log hands out annotation identifiers, so that sessions writing to the same
+file never use the same identifier. The next identifier follows the highest
+identifier in the file when it was first read.
+
+Appends are group committed. The first writer to arrive writes and fsyncs all
+lines that are pending at that time, writers that arrive while that happens
+wait and are committed together in the next batch. An append only returns
+when its line is on disk.
+
+A line that was torn by a crash can only be at the end of the file. When the
+file is first read by a process a trailing partial line is cut off and saved
+in a separate file. A last line that only misses its newline, for example
+after editing the file by hand, is kept and gets its newline. Complete lines
+with a bad checksum are always skipped.
+
+The module also has the link index that annotator instances serving shards of
+the corpus use to share links with each other.
+
+"""
+
+import os
+import time
+import zlib
+import threading
+import collections
+
+import config
+from utils import Metrics
+
+
+ANNOTATION_FIELDS = 8
+
+
+def add_checksum(line: str) -> str:
+    """Return the line with a checksum field added, the line should have all
+    eight annotation fields, including the comment."""
+    return '%s\t#%08x' % (line, zlib.crc32(line.encode('utf8')))
+
+
+def strip_checksum(line: str):
+    """Return the line without its checksum and a boolean that is False if the
+    line had a checksum that did not match. Only a field after the eight
+    annotation fields is a checksum."""
+    fields = line.split('\t')
+    if len(fields) <= ANNOTATION_FIELDS:
+        return line, True
+    body, _sep, last = line.rpartition('\t')
+    return body, (len(fields) == ANNOTATION_FIELDS + 1
+                  and last == '#%08x' % zlib.crc32(body.encode('utf8')))
+
+
+def is_complete(line: str, previous: str = None) -> bool:
+    """Return True if a last line without a newline is still a complete
+    annotation. That is the case if its checksum matches, or if it has no
+    checksum but does have valid annotation fields and the previous line has
+    no checksum either, which means the file was written by an older version."""
+    fields = line.split('\t')
+    if len(fields) == ANNOTATION_FIELDS + 1:
+        return strip_checksum(line)[1]
+    if previous is not None and len(previous.split('\t')) > ANNOTATION_FIELDS:
+        return False
+    return (len(fields) in (ANNOTATION_FIELDS - 1, ANNOTATION_FIELDS)
+            and fields[0].isdigit() and fields[5].isdigit())
+
+
+class AnnotationLog(object):
+
+    """Append-only annotations file with checksummed lines and group commit.
+    There is one instance per file so that all sessions of the annotator share
+    the same writer, use AnnotationLog.get() to obtain it.
+
+    file_name: str        -  the annotations file
+    commit_delay: float   -  seconds a batch leader waits for more lines
+    pending: list         -  lines waiting to be written
+    last_identifier: int  -  identifier of the last annotation, None until read
+    appended: int         -  sequence number of the last appended line
+    committed: int        -  sequence number of the last line on disk
+    corrupt_lines: int    -  number of lines with a bad checksum at last read
+    torn_bytes: int       -  number of bytes cut off the end at last read
+
+    """
+
+    _logs = {}
+    _logs_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, file_name: str):
+        """Return the shared log for the file, creating it if needed."""
+        key = os.path.abspath(file_name)
+        with cls._logs_lock:
+            if key not in cls._logs:
+                cls._logs[key] = cls(file_name)
+            return cls._logs[key]
+
+    def __init__(self, file_name: str, commit_delay: float = None):
+        self.file_name = file_name
+        self.commit_delay = config.COMMIT_DELAY if commit_delay is None else commit_delay
+        self.pending = []
+        self.last_identifier = None
+        self.appended = 0
+        self.committed = 0
+        self.corrupt_lines = 0
+        self.torn_bytes = 0
+        self._recovered = False
+        self._flushing = False
+        self._condition = threading.Condition()
+        self._fh = None
+
+    def __str__(self):
+        return '<AnnotationLog %s committed=%d>' % (self.file_name, self.committed)
+
+    def append(self, line: str) -> int:
+        """Append a line with the seven fields of an annotation that follow the
+        identifier. The line is written with a new identifier in front of it,
+        the identifier is returned when the line is safely on disk."""
+        if len(line.split('\t')) != ANNOTATION_FIELDS - 1:
+            raise ValueError('Expected %d fields in %r' % (ANNOTATION_FIELDS - 1, line))
+        with self._condition:
+            if self.last_identifier is None:
+                self.read()
+            self.last_identifier += 1
+            identifier = self.last_identifier
+            self.pending.append(add_checksum('%d\t%s' % (identifier, line)) + '\n')
+            self.appended += 1
+            sequence_number = self.appended
+            while self._flushing and self.committed < sequence_number:
+                self._condition.wait()
+            if self.committed >= sequence_number:
+                return identifier
+            self._flushing = True
+        self._commit()
+        return identifier
+
+    def _commit(self):
+        """Write and fsync all pending lines, this is only ever run by one
+        thread at a time. On failure the lines are put back so the next writer
+        will try them again."""
+        if self.commit_delay:
+            time.sleep(self.commit_delay)
+        with self._condition:
+            batch, self.pending = self.pending, []
+            last = self.appended
+        is_written = False
+        try:
+            if self._fh is None:
+                self._fh = open(self.file_name, 'a', encoding='utf8')
+            self._fh.write(''.join(batch))
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            is_written = True
+        except OSError:
+            with self._condition:
+                self.pending = batch + self.pending
+            self._close()
+            raise
+        finally:
+            with self._condition:
+                self._flushing = False
+                if is_written:
+                    self.committed = last
+                self._condition.notify_all()
+
+    def _close(self):
+        if self._fh is not None:
+            try:
+                self._fh.close()
+            except OSError:
+                pass
+            self._fh = None
+
+    def read(self, recover=True) -> list:
+        """Return all intact lines in the file, without checksums. On the first
+        read a torn last line is removed from the file and saved in a file with
+        the extension .torn added. Later reads never change the file since the
+        last line may be in the process of being written, so they just ignore
+        a last line without a newline. Lines with a bad checksum are skipped.
+        Use recover=False to read a file that another process may be writing.
+        Reading also makes sure that new identifiers follow the ones in the
+        file."""
+        with self._condition:
+            if recover and not self._recovered:
+                self._recover()
+                self._recovered = True
+            lines = []
+            last_identifier = self.last_identifier or 0
+            self.corrupt_lines = 0
+            with open(self.file_name, encoding='utf8', errors='replace') as fh:
+                for line in fh:
+                    if not line.endswith('\n'):
+                        break
+                    line, is_intact = strip_checksum(line[:-1])
+                    if is_intact:
+                        lines.append(line)
+                        identifier = line.split('\t', 1)[0]
+                        if identifier.isdigit():
+                            last_identifier = max(last_identifier, int(identifier))
+                    else:
+                        self.corrupt_lines += 1
+            self.last_identifier = last_identifier
+            return lines
+
+    def read_from(self, offset: int = 0):
+        """Return the intact lines after a byte offset, without checksums, and
+        the offset after the last complete line. This lets a reader keep up
+        with the file without reading all of it again. If the file is shorter
+        than the offset it was replaced and is read from the start."""
+        lines = []
+        if not os.path.exists(self.file_name):
+            return lines, 0
+        with open(self.file_name, 'rb') as fh:
+            if fh.seek(0, os.SEEK_END) < offset:
+                offset = 0
+            fh.seek(offset)
+            for line in fh:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                line, is_intact = strip_checksum(line[:-1].decode('utf8', errors='replace'))
+                if is_intact:
+                    lines.append(line)
+        return lines, offset
+
+    def _recover(self):
+        """Cut off anything after the last newline, unless it is a complete
+        annotation that only misses its newline, in which case the newline is
+        added."""
+        self.torn_bytes = 0
+        if not os.path.exists(self.file_name):
+            open(self.file_name, 'a').close()
+            return
+        with open(self.file_name, 'rb+') as fh:
+            size = fh.seek(0, os.SEEK_END)
+            if size == 0:
+                return
+            position = size
+            while position > 0:
+                step = min(4096, position)
+                fh.seek(position - step)
+                chunk = fh.read(step)
+                newline = chunk.rfind(b'\n')
+                if newline >= 0:
+                    position = position - step + newline + 1
+                    break
+                position -= step
+            if position < size:
+                fh.seek(position)
+                torn = fh.read()
+                previous = None
+                if position > 0:
+                    start = max(0, position - 65536)
+                    fh.seek(start)
+                    previous = fh.read(position - start)[:-1].rsplit(b'\n', 1)[-1]
+                    previous = previous.decode('utf8', errors='replace')
+                if is_complete(torn.decode('utf8', errors='replace'), previous):
+                    fh.seek(size)
+                    fh.write(b'\n')
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                    return
+                with open(self.file_name + '.torn', 'ab') as torn_fh:
+                    torn_fh.write(torn + b'\n')
+                fh.truncate(position)
+                fh.flush()
+                os.fsync(fh.fileno())
+                self.torn_bytes = len(torn)
+
+
+class LinkIndex(object):
+
+    """Read-only index of the links in a set of annotation logs, used to share
+    link evidence between annotator instances that each serve a shard of the
+    corpus. The index file has one line for each entity text, entity class and
+    link, with the number of entity types that link was given to.
+
+    file_name: str  -  the index file
+    mtime: int      -  modification time of the index file when it was read
+    links: dict     -  { (entity text, entity class) => Counter of links }
+    by_text: dict   -  { entity text => Counter of links }
+
+    """
+
+    _indexes = {}
+
+    @classmethod
+    def load(cls, file_name: str):
+        """Return the index in the file, or None if there is no such file. The
+        index is only read again if the file has changed."""
+        try:
+            mtime = os.stat(file_name).st_mtime_ns
+        except OSError:
+            return None
+        index = cls._indexes.get(file_name)
+        if index is None or index.mtime != mtime:
+            Metrics.count('link index cache misses')
+            index = cls(file_name, mtime)
+            cls._indexes[file_name] = index
+        else:
+            Metrics.count('link index cache hits')
+        return index
+
+    def __init__(self, file_name: str, mtime: int = None):
+        self.file_name = file_name
+        self.mtime = mtime
+        self.links = {}
+        self.by_text = {}
+        with open(file_name, encoding='utf8') as fh:
+            for line in fh:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == 4 and fields[3].isdigit():
+                    text, entity_class, link, count = fields
+                    self.links.setdefault((text, entity_class), collections.Counter())[link] += int(count)
+                    self.by_text.setdefault(text, collections.Counter())[link] += int(count)
+
+    def __str__(self):
+        return '<LinkIndex %s entities=%d>' % (self.file_name, len(self.links))
+
+    def suggest(self, text: str):
+        """Return the most common link for the text, or None."""
+        counter = self.by_text.get(text)
+        return counter.most_common(1)[0][0] if counter else None
+
+    @staticmethod
+    def write(file_name: str, links: dict):
+        """Write an index file from a dictionary like the links dictionary. The
+        file is replaced in one go so readers never see a partial index."""
+        tmp_file = file_name + '.tmp'
+        with open(tmp_file, 'w', encoding='utf8') as fh:
+            for (text, entity_class) in sorted(links):
+                for link, count in links[(text, entity_class)].most_common():
+                    fh.write('%s\t%s\t%s\t%d\n' % (text, entity_class, link, count))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_file, file_name)
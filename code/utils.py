@@ -1,11 +1,18 @@
+import json
+import time
 import datetime
 import inspect
-
-import requests
-import pandas as pd
+import contextlib
+import collections
 
 import config
 
+# The requests and pandas modules are slow to import and only needed for link
+# validation and for tables, so they are imported in the functions using them
+
+# Contents of static files, see read_static()
+_static_files = {}
+
 
 def timestamp():
     """Return a timestamp in "YYYY-MM-DD hh:mm:ss" format."""
@@ -58,6 +65,100 @@ class Messages:
         cls.log(text, entry_type='ERROR', source=source)
 
 
+class Metrics:
+
+    """Timers and counters for the hot paths of the annotator. Like Messages
+    this keeps its state on the class so it survives Streamlit reruns. Nothing
+    is recorded unless profiling was switched on with the 'profiling' argument.
+
+    timings   -  { timer-name => deque of durations in seconds }
+    counters  -  { counter-name => int }
+
+    """
+
+    timings = {}
+    counters = collections.Counter()
+
+    @classmethod
+    def reset(cls):
+        cls.timings = {}
+        cls.counters = collections.Counter()
+
+    @classmethod
+    @contextlib.contextmanager
+    def timer(cls, name: str):
+        """Context manager that records how long the body took."""
+        if not config.PROFILING:
+            yield
+            return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.record(name, time.perf_counter() - t0)
+
+    @classmethod
+    def record(cls, name: str, seconds: float):
+        if config.PROFILING:
+            samples = cls.timings.get(name)
+            if samples is None:
+                samples = collections.deque(maxlen=config.MAX_TIMING_SAMPLES)
+                cls.timings[name] = samples
+            samples.append(seconds)
+
+    @classmethod
+    def count(cls, name: str, increment: int = 1):
+        if config.PROFILING:
+            cls.counters[name] += increment
+
+    @classmethod
+    def timer_summary(cls) -> list:
+        """Return rows with timer name, number of samples, and the mean, p50,
+        p90, p99 and maximum latency in milliseconds."""
+        rows = []
+        for name in sorted(cls.timings):
+            samples = sorted(cls.timings[name])
+            if not samples:
+                continue
+            rows.append([name, len(samples),
+                         _ms(sum(samples) / len(samples)),
+                         _ms(_percentile(samples, 50)),
+                         _ms(_percentile(samples, 90)),
+                         _ms(_percentile(samples, 99)),
+                         _ms(samples[-1])])
+        return rows
+
+    @classmethod
+    def counter_summary(cls) -> list:
+        return [[name, cls.counters[name]] for name in sorted(cls.counters)]
+
+    @classmethod
+    def as_json(cls) -> str:
+        columns = ('count', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms')
+        timers = {row[0]: dict(zip(columns, row[1:])) for row in cls.timer_summary()}
+        return json.dumps({'timestamp': timestamp(),
+                           'timers': timers,
+                           'counters': dict(cls.counters)}, indent=2)
+
+    @classmethod
+    def dump(cls, file_name: str = None):
+        """Write the metrics to a JSON file, overwriting the previous dump."""
+        if config.PROFILING:
+            file_name = config.METRICS_FILE if file_name is None else file_name
+            with open(file_name, 'w') as fh:
+                fh.write(cls.as_json())
+
+
+def _percentile(sorted_samples: list, percentile: int) -> float:
+    """Nearest-rank percentile of a sorted list of samples."""
+    rank = max(1, round(percentile / 100 * len(sorted_samples)))
+    return sorted_samples[min(rank, len(sorted_samples)) - 1]
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 3)
+
+
 def feature_as_string(feature_name: str, feature_value: object):
     return f'{feature_name:15s}  =  {feature_value}'
 
@@ -102,35 +203,72 @@ def validate_link(link: str):
     it exists as a URL."""
     if not link:
         return True
+    import requests
     return True if requests.get(link).status_code == 200 else False
 
 
+def dataframe(rows, columns):
+    """Return a pandas DataFrame for the rows."""
+    import pandas as pd
+    return pd.DataFrame(rows, columns=columns)
+
+
+def read_static(file_name: str) -> str:
+    """Return the content of a static file, it is only read from disk the
+    first time it is asked for."""
+    if file_name in _static_files:
+        Metrics.count('static file cache hits')
+    else:
+        Metrics.count('static file cache misses')
+        with open(file_name) as fh:
+            _static_files[file_name] = fh.read()
+    return _static_files[file_name]
+
+
 def html(streamlit, text: str):
     """Writes a texts as html using streamlit."""
     streamlit.markdown(text, unsafe_allow_html=True)
 
 
-def show_progress(streamlit, corpus):
-    total_types, percentage_done, done_per_file = corpus.status()
-    # streamlit.write('Done %d%% of %d types' % (round(percentage_done), total_types))
-    streamlit.table(pd.DataFrame(done_per_file, columns=['file', 'entities', '% done']))
+def show_progress(streamlit, corpus, link_annotations):
+    # imported here because it imports pandas
+    from stats import CorpusStatistics
+    statistics = CorpusStatistics.get(corpus, link_annotations)
+    streamlit.write('Corpus')
+    streamlit.table(statistics.corpus_summary())
+    streamlit.write('Entity classes')
+    streamlit.table(statistics.per_class())
+    streamlit.write('Most frequent unlinked entities')
+    streamlit.table(statistics.top_unlinked(config.MAX_PROGRESS_ROWS))
+    streamlit.write('Most frequent links')
+    streamlit.table(statistics.link_distribution(config.MAX_PROGRESS_ROWS))
+    streamlit.write('Files')
+    streamlit.table(statistics.per_file())
 
 
 def show_messages(streamlit):
-    streamlit.table(pd.DataFrame(Messages.messages,
-                                 columns=['timestamp', 'type', 'message']))
+    streamlit.table(dataframe(Messages.messages,
+                              columns=['timestamp', 'type', 'message']))
+
+
+def show_metrics(streamlit):
+    streamlit.write('Timers (milliseconds)')
+    streamlit.table(
+        dataframe(Metrics.timer_summary(),
+                  columns=['timer', 'count', 'mean', 'p50', 'p90', 'p99', 'max']))
+    streamlit.write('Counters')
+    streamlit.table(dataframe(Metrics.counter_summary(), columns=['counter', 'count']))
 
 
 def show_state(streamlit, module):
     streamlit.table(
-        pd.DataFrame(
+        dataframe(
             all_vars(module, streamlit.session_state),
             columns=['type', 'variable', 'value']))
 
 
 def show_help(st):
-    with open('../docs/help.md') as fh:
-        st.markdown(fh.read())
+    st.markdown(read_static('../docs/help.md'))
 
 
 def show_annotations(streamlit, annotations, callback=None):
@@ -139,7 +277,7 @@ def show_annotations(streamlit, annotations, callback=None):
     annos = annos[:config.MAX_ANNOTATIONS_DISPLAYED]
     table = annotations_as_table(annos)
     streamlit.table(
-        pd.DataFrame(table, columns=['id', 'file', 'n', 'text', 'type', 'link', 'comment']))
+        dataframe(table, columns=['id', 'file', 'n', 'text', 'type', 'link', 'comment']))
     streamlit.text_input('Display entity', key='display')
     if streamlit.session_state.display:
         idx = int(streamlit.session_state.display)
@@ -158,6 +296,11 @@ def show_annotations(streamlit, annotations, callback=None):
             streamlit.text_input("Fix link", key='entity_type_fix',
                                  on_change=callback, args=(entity,),
                                  value=link_and_comment, label_visibility='hidden')
+            if streamlit.checkbox('Show history', key='history'):
+                history = annotations.history(entity.file_name, entity.text())
+                streamlit.table(
+                    dataframe(annotations_as_table(reversed(history)),
+                              columns=['id', 'file', 'n', 'text', 'type', 'link', 'comment']))
 
 
 def annotations_as_table(annotations):
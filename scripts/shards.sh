@@ -0,0 +1,39 @@
+#!/bin/bash
+
+# Script to serve the corpus from several containers, each with its own shard
+# of the files, and to periodically rebuild the link index that the containers
+# use to share links with each other
+#
+# Takes an image tag, the number of shards and optionally the first port and
+# the number of seconds between index rebuilds, shard N runs on the first port
+# plus N
+#
+# Usage:
+#     sh shards.sh 0.1.0 4
+#     sh shards.sh 0.1.0 4 8510 600
+#
+# Stop the index rebuilding with Ctrl-C, the containers keep running. To merge
+# the shard annotations into one file:
+#
+#     docker run --rm -v $PWD/data:/data --entrypoint sh link-annotator:0.1.0 \
+#         -c "python merge.py --output /data/annotations-merged.tab /data/annotations-shard-*.tab"
+
+version=$1
+shards=$2
+port=8501
+interval=300
+
+if [[ "$3" ]]; then port=$3; fi
+if [[ "$4" ]]; then interval=$4; fi
+
+for (( shard=0; shard<${shards}; shard++ )); do
+    shard_port=$((port + shard))
+    echo "docker run -idt --rm -p ${shard_port}:8501 -v $PWD/data:/data link-annotator:${version} shard=${shard}/${shards}"
+    docker run -idt --rm -p ${shard_port}:8501 -v $PWD/data:/data link-annotator:${version} shard=${shard}/${shards}
+done
+
+while true; do
+    sleep ${interval}
+    docker run --rm -v $PWD/data:/data --entrypoint sh link-annotator:${version} \
+        -c "python merge.py --index /data/link-index.tab /data/annotations-shard-*-of-${shards}.tab"
+done